@@ -4,14 +4,24 @@
 import os
 import sys
 import csv
+import json
 import subprocess
 import threading
 import time
 import logging
+import queue
+import random
+import shlex
+import shutil
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+from functools import lru_cache
 from dotenv import load_dotenv
 from pathlib import Path
 import re
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 # ---------- Console & process encoding ----------
 # Make stdout/stderr UTF-8 (prevents Windows cp1252 crashes on emoji/unicode)
@@ -27,20 +37,44 @@ load_dotenv()
 
 GH_SOURCE_PAT = os.getenv("GH_SOURCE_PAT")
 GH_PAT = os.getenv("GH_PAT")
+# Optional comma-separated token pools; each running migration borrows one pair
+GH_SOURCE_PAT_POOL = os.getenv("GH_SOURCE_PAT_POOL", "")
+GH_PAT_POOL = os.getenv("GH_PAT_POOL", "")
 SOURCE_ORG = os.getenv("SOURCE")
 DESTINATION_ORG = os.getenv("DESTINATION")
 TARGET_API_URL = os.getenv("TARGET_API_URL", "https://api.github.com")
+# Number of migrations to run at the same time (each one is network-bound)
+MIGRATE_CONCURRENCY = max(1, int(os.getenv("MIGRATE_CONCURRENCY", "4")))
+# Attempts per repo when a migration fails with a transient error (rate limit, 5xx, timeout)
+MIGRATE_MAX_ATTEMPTS = max(1, int(os.getenv("MIGRATE_MAX_ATTEMPTS", "4")))
+# Skip rows whose target repo already exists in DESTINATION (SKIP_EXISTING=0 to disable)
+SKIP_EXISTING = os.getenv("SKIP_EXISTING", "1") != "0"
+# "gh" runs `gh gei migrate-repo` per repo; "api" talks to the GraphQL API directly
+MIGRATION_BACKEND = os.getenv("MIGRATION_BACKEND", "gh").strip().lower()
+# Base URL of the source GitHub instance (used to build sourceRepositoryUrl for the api backend)
+SOURCE_URL = os.getenv("SOURCE_URL", "https://github.com").rstrip("/")
+
+# --dry-run: validate env, parse the CSV and print what would run, without running it
+DRY_RUN = "--dry-run" in sys.argv[1:]
+
+def _split_tokens(pool):
+    """Parse a comma-separated token pool, ignoring blank entries."""
+    return [token.strip() for token in pool.split(",") if token.strip()]
+
+# Validate environment (only the token variables can be satisfied by their pool)
+REQUIRED = ("GH_SOURCE_PAT", "GH_PAT", "SOURCE", "DESTINATION")
+POOL_FOR = {"GH_SOURCE_PAT": GH_SOURCE_PAT_POOL, "GH_PAT": GH_PAT_POOL}
+_missing = [
+    name for name in REQUIRED
+    if not ((os.environ.get(name) or "").strip() or _split_tokens(POOL_FOR.get(name, "")))
+]
+if _missing:
+    print(f"[ERROR] Environment variable(s) {', '.join(_missing)} not set. Exiting.", flush=True)
+    raise SystemExit(1)
 
-# Validate environment
-for var_name, var_value in [
-    ("GH_SOURCE_PAT", GH_SOURCE_PAT),
-    ("GH_PAT", GH_PAT),
-    ("SOURCE", SOURCE_ORG),
-    ("DESTINATION", DESTINATION_ORG),
-]:
-    if not var_value:
-        print(f"[ERROR] Environment variable {var_name} not set. Exiting.", flush=True)
-        raise SystemExit(1)
+if MIGRATION_BACKEND not in ("gh", "api"):
+    print(f"[ERROR] MIGRATION_BACKEND must be 'gh' or 'api', got '{MIGRATION_BACKEND}'. Exiting.", flush=True)
+    raise SystemExit(1)
 
 # CSV file
 CSV_FILE = os.path.join(os.getcwd(), "repos.csv")
@@ -52,6 +86,20 @@ if not os.path.exists(CSV_FILE):
 LOGS_DIR = Path("logs")
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_FILE = "MigrationDetails.csv"
+# Summary CSV columns; _migrate_one returns its row in this order
+FIELDNAMES = [
+    "SourceOrg", "SourceRepo", "TargetOrg", "TargetRepo",
+    "Status", "StartTime", "EndTime", "TimeTakenSeconds", "TimeTakenMinutes", "LogFile", "Attempts"
+]
+
+# QUIET=1 keeps per-repo output out of the console (it still goes to the log files)
+QUIET = os.getenv("QUIET", "") == "1"
+# Per-repo log writes are handed to one background thread as (path, bytes);
+# (path, None) closes that file and a bare None stops the thread.
+LOG_Q = queue.Queue(maxsize=1024)
+# Only the end of each migration's output is kept in memory (for the error log);
+# the full output lives in the per-repo log file.
+OUTPUT_TAIL_BYTES = 64 * 1024
 
 # Error log (UTF-8)
 logging.basicConfig(
@@ -61,158 +109,867 @@ logging.basicConfig(
     encoding="utf-8",
 )
 
+# Set on Ctrl+C: no new migration or retry starts once it is set
+ABORT = threading.Event()
+# Running gh processes, so an abort can terminate them
+_live_procs = set()
+_live_procs_lock = threading.Lock()
+
 # gh CLI (set full path if not in PATH)
 GH_CLI = "gh"  # e.g., r"C:\Program Files\GitHub CLI\gh.exe"
 
+# Resolve gh once up front so each migration spawns it by absolute path
+# (no PATH search per process) and a missing CLI fails before any work starts.
+if MIGRATION_BACKEND == "gh":
+    _gh_path = shutil.which(GH_CLI)
+    if not _gh_path and DRY_RUN:
+        print(f"[WARN] GitHub CLI '{GH_CLI}' not found; it is required for a real run.", flush=True)
+    elif not _gh_path:
+        print(f"[ERROR] GitHub CLI '{GH_CLI}' not found. Install it or set GH_CLI in this script to its full path. Exiting.", flush=True)
+        raise SystemExit(1)
+    else:
+        GH_CLI = _gh_path
+
+# ---------- GraphQL API (MIGRATION_BACKEND=api) ----------
+GRAPHQL_URL = f"{TARGET_API_URL.rstrip('/')}/graphql"
+# One pooled keep-alive session shared by all workers
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+# Pause when fewer than this many requests are left in the rate-limit window
+RATE_LIMIT_FLOOR = 100
+# Terminal RepositoryMigration states
+FINISHED_STATES = {"SUCCEEDED", "FAILED", "FAILED_VALIDATION"}
+# Target org id and migration source id, looked up once per run
+_api_ids = {}
+_api_ids_lock = threading.Lock()
+# All in-flight migrations are polled together by one background thread
+POLL_INTERVAL_SECONDS = 10
+POLL_BATCH_SIZE = 50  # aliased node() lookups per GraphQL request
+# A migration whose status could not be read this many ticks in a row is given up on
+MAX_POLL_FAILURES = 10
+# Target repos checked per GraphQL request by the existing-repo preflight
+PREFLIGHT_BATCH_SIZE = 100
+# migration id -> {"future": Future, "token": str, "on_state": callable, "state": str, "failures": int}
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_poller = None
+# ---------------------------------------------------------
+
+# Anything that's not alnum, dot, dash, or underscore
+_SAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+@lru_cache(maxsize=4096)
 def safe_log_name(name: str) -> str:
     """Sanitize a string for use as a filename."""
-    # Replace anything that's not alnum, dot, dash, or underscore
-    return re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+    return _SAFE_RE.sub("_", name)
 
-def run_streaming(cmd, live_prefix="", log_path=None, env=None):
+# Failure output that suggests the migration is worth retrying
+_RETRYABLE_RE = re.compile(r"(rate limit|HTTP 5\d\d|5\d\d Server Error|timeout|timed out|temporarily)", re.I)
+
+def _is_retryable(output: str) -> bool:
+    """True if a failed gh migration's output looks like a transient error."""
+    return bool(_RETRYABLE_RE.search(output))
+
+# gh gei prints the queued migration's id, and "Migration failed" / "State: FAILED" when it fails
+_MIGRATION_ID_RE = re.compile(r"\b(RM_[A-Za-z0-9_-]+)")
+_MIGRATION_FAILED_RE = re.compile(r"(Migration failed|State: FAILED)", re.I)
+
+def _queued_migration_id(output: str):
+    """
+    Return the id of a migration gh gei queued but did not see finish (so it
+    should be waited on, not started again), or None if nothing was queued
+    or the queued migration failed.
     """
-    Run a shell command and stream stdout/stderr to console in real time.
-    Also collects the full output and optionally writes to a log file.
-    Returns (success: bool, combined_output: str)
+    ids = _MIGRATION_ID_RE.findall(output)
+    if not ids or _MIGRATION_FAILED_RE.search(output):
+        return None
+    return ids[-1]
+
+def token_pairs():
+    """
+    Build (source_token, target_token) pairs from the token pools.
+    Falls back to GH_SOURCE_PAT / GH_PAT when a pool is empty; the shorter
+    pool is cycled so every pair has both tokens.
     """
-    # Prepare per-repo log file if requested
-    log_file = None
+    source_tokens = _split_tokens(GH_SOURCE_PAT_POOL) or [GH_SOURCE_PAT]
+    target_tokens = _split_tokens(GH_PAT_POOL) or [GH_PAT]
+    count = max(len(source_tokens), len(target_tokens))
+    return [
+        (source_tokens[i % len(source_tokens)], target_tokens[i % len(target_tokens)])
+        for i in range(count)
+    ]
+
+def _close_log(path, handle):
+    """Close a log handle, warning instead of raising if the flush fails."""
     try:
+        handle.close()
+    except OSError as e:
+        print(f"[WARN] Could not close log file {path}: {e}", flush=True)
+
+def _log_writer():
+    """
+    Background thread: write queued log chunks, keeping one open handle per path.
+    A path is truncated the first time it is opened and appended to after that,
+    so retries of the same repo add to its log instead of replacing it.
+    A failing log (disk full, file removed) is warned about and dropped; the
+    thread keeps draining LOG_Q so workers never block on a dead writer.
+    """
+    handles = {}
+    opened = set()
+    while True:
+        item = LOG_Q.get()
+        if item is None:
+            break
+        path, data = item
+        if data is None:
+            handle = handles.pop(path, None)
+            if handle:
+                _close_log(path, handle)
+            continue
+        if path not in handles:
+            try:
+                # 64 KiB buffer: far fewer write syscalls for chatty migrations
+                handles[path] = open(path, "ab" if path in opened else "wb", buffering=1 << 16)
+                opened.add(path)
+            except Exception as e:
+                print(f"[WARN] Could not open log file {path}: {e}", flush=True)
+                handles[path] = None
+        if handles[path]:
+            try:
+                handles[path].write(data)
+            except OSError as e:
+                print(f"[WARN] Could not write log file {path}, dropping it: {e}", flush=True)
+                _close_log(path, handles[path])
+                handles[path] = None
+    for path, handle in handles.items():
+        if handle:
+            _close_log(path, handle)
+
+def start_log_writer():
+    """Start the log writer thread; returns it so the caller can stop_log_writer() it."""
+    writer = threading.Thread(target=_log_writer, name="log-writer", daemon=True)
+    writer.start()
+    return writer
+
+def stop_log_writer(writer):
+    """Flush and close all queued logs, then wait for the writer thread to exit."""
+    LOG_Q.put(None)
+    writer.join()
+
+def run_streaming(cmd, live_prefix="", log_path=None, env=None):
+    """
+    Run a command (argv list, no shell) and stream stdout/stderr to console in real time.
+    Output is read from the pipe in 64 KiB chunks and passed through as bytes;
+    complete lines go to the console (each tagged with live_prefix, unless
+    QUIET) and to the optional log file via the log writer thread.
+    Returns (success: bool, output_tail: str) where output_tail is at most the
+    last OUTPUT_TAIL_BYTES of output.
+    """
+    # Prepare per-repo log file if requested (created even if there is no output).
+    # Log files live directly in LOGS_DIR, which is created at startup.
+    if log_path:
+        LOG_Q.put((log_path, b""))
+
+    if ABORT.is_set():
         if log_path:
-            os.makedirs(os.path.dirname(log_path), exist_ok=True)
-            log_file = open(log_path, "w", encoding="utf-8")
-    except Exception as e:
-        print(f"[WARN] Could not open log file {log_path}: {e}", flush=True)
+            LOG_Q.put((log_path, b"[ABORTED] Interrupted by user.\n"))
+            LOG_Q.put((log_path, None))
+        return False, "[ABORTED] Interrupted by user.\n"
 
     # Merge stderr into stdout so we see everything
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        encoding="utf-8",
-        bufsize=1,     # line-buffered
-        shell=True,    # Fine from Git Bash / PowerShell; quoting is already added
-        env=env
-    )
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            shell=False,   # argv list: no extra sh / cmd.exe process and no quoting to get wrong
+            env=env
+        )
+    except OSError as e:
+        # Without a shell, a missing executable raises instead of exiting 127
+        message = f"[ERROR] Could not start {cmd[0]}: {e}\n"
+        print(f"{live_prefix}{message}", end="", flush=True)
+        if log_path:
+            LOG_Q.put((log_path, message.encode("utf-8")))
+            LOG_Q.put((log_path, None))
+        return False, message
+
+    # Register the child so abort_migrations() can stop it; one started just
+    # after an abort is stopped right away.
+    with _live_procs_lock:
+        if ABORT.is_set():
+            proc.terminate()
+        _live_procs.add(proc)
+
+    prefix = live_prefix.encode("utf-8")
+    output = bytearray()
+    pending = bytearray()
+
+    def emit(data):
+        # `data` is one or more complete lines
+        if not QUIET:
+            sys.stdout.buffer.write(prefix + data.replace(b"\n", b"\n" + prefix, data.count(b"\n") - 1))
+            sys.stdout.buffer.flush()
+        output.extend(data)
+        if len(output) > OUTPUT_TAIL_BYTES:
+            # Drop the oldest bytes, starting the tail on a whole line
+            del output[:-OUTPUT_TAIL_BYTES]
+            del output[:output.find(b"\n") + 1]
+        if log_path:
+            LOG_Q.put((log_path, data))
 
-    output_lines = []
+    fd = proc.stdout.fileno()
     try:
-        for line in proc.stdout:
-            # Print each line as it arrives
-            line = line.rstrip("\n")
-            print(f"{live_prefix}{line}", flush=True)
-            output_lines.append(line + "\n")
-            if log_file:
-                log_file.write(line + "\n")
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            pending += chunk
+            cut = pending.rfind(b"\n") + 1
+            if cut:
+                emit(bytes(pending[:cut]))
+                del pending[:cut]
+        if pending:
+            emit(bytes(pending) + b"\n")
 
         proc.wait()
         success = (proc.returncode == 0)
-    except KeyboardInterrupt:
-        # If user hits Ctrl+C, stop the child process as well
-        try:
-            proc.terminate()
-        except Exception:
-            pass
-        success = False
-        output_lines.append("\n[ABORTED] Interrupted by user.\n")
-        if log_file:
-            log_file.write("\n[ABORTED] Interrupted by user.\n")
+        if ABORT.is_set() and not success:
+            # Ctrl+C reaches only the main thread; abort_migrations() stopped this child
+            output.extend(b"\n[ABORTED] Interrupted by user.\n")
+            if log_path:
+                LOG_Q.put((log_path, b"\n[ABORTED] Interrupted by user.\n"))
     finally:
-        if log_file:
-            log_file.close()
+        with _live_procs_lock:
+            _live_procs.discard(proc)
+        proc.stdout.close()
+        if log_path:
+            LOG_Q.put((log_path, None))
 
-    return success, "".join(output_lines)
+    return success, output.decode("utf-8", errors="replace")
 
-def migrate_repos(csv_file):
-    # Read CSV with UTF-8 (support BOM). Expect headers: CURRENT-NAME, NEW-NAME
-    with open(csv_file, newline="", encoding="utf-8-sig", errors="replace") as f:
-        reader = csv.DictReader(f)
-        repo_list = [row for row in reader if (row.get("CURRENT-NAME") or "").strip()]
+def iter_repo_rows(csv_in):
+    """
+    Lazily yield (source_repo, target_repo) from an open CSV file.
+    Expects headers CURRENT-NAME and (optionally) NEW-NAME; rows without a
+    CURRENT-NAME are skipped and a blank NEW-NAME reuses CURRENT-NAME.
+    """
+    reader = csv.reader(csv_in)
+    header = [name.strip() for name in next(reader, [])]
+    if "CURRENT-NAME" not in header:
+        print("[ERROR] CSV has no CURRENT-NAME column. Exiting.", flush=True)
+        raise SystemExit(1)
+    src_i = header.index("CURRENT-NAME")
+    tgt_i = header.index("NEW-NAME") if "NEW-NAME" in header else None
+
+    for row in reader:
+        source_repo = row[src_i].strip() if src_i < len(row) else ""
+        if not source_repo:
+            continue
+        target_repo = row[tgt_i].strip() if tgt_i is not None and tgt_i < len(row) else ""
+        yield source_repo, target_repo or source_repo
+
+def _csv_time(moment):
+    """Format a UTC datetime as 'YYYY-MM-DD HH:MM:SS' (isoformat is cheaper than strftime)."""
+    return moment.replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+
+def build_cmd(source_repo, target_repo):
+    """Return the gh gei argv list that migrates one repo."""
+    return [
+        GH_CLI, "gei", "migrate-repo",
+        "--github-source-org", SOURCE_ORG,
+        "--source-repo", source_repo,
+        "--github-target-org", DESTINATION_ORG,
+        "--target-repo", target_repo,
+        "--target-api-url", TARGET_API_URL,
+    ]
 
-    total = len(repo_list)
-    if total == 0:
-        print("[INFO] No repositories found in CSV (CURRENT-NAME column). Nothing to do.", flush=True)
-        return
+def build_wait_cmd(migration_id):
+    """Return the gh gei argv list that waits for an already queued migration."""
+    return [
+        GH_CLI, "gei", "wait-for-migration",
+        "--migration-id", migration_id,
+        "--target-api-url", TARGET_API_URL,
+    ]
 
-    print(f"[INFO] Loaded {total} repo(s) from {csv_file}", flush=True)
+def _migrate_one(source_repo, target_repo, progress, tokens):
+    """
+    Migrate a single repo and return its summary row (FIELDNAMES order).
+    `progress` is a dict holding the shared `completed` counter and its lock.
+    `tokens` is a queue of (token_index, source_token, target_token) to borrow from.
+    """
+    print(f"\nStarting migration: {SOURCE_ORG}/{source_repo} -> {DESTINATION_ORG}/{target_repo}", flush=True)
 
-    results = []
-    completed = 0
+    # Wall clock for the CSV timestamps, monotonic clock for the duration
+    start_time = datetime.now(timezone.utc)
+    start_mono = time.monotonic()
+    per_repo_log = LOGS_DIR / f"{safe_log_name(source_repo)}__to__{safe_log_name(target_repo)}.log"
 
-    # Prepare environment for gh command (ensure PATs available to the process)
-    # If you need different tokens for source/target, gh gei uses environment variables internally.
-    # Keep current process env and pass through.
-    env = os.environ.copy()
+    # Borrow a token pair so parallel migrations spread over several users' rate limits
+    token_index, source_token, target_token = tokens.get()
+    try:
+        print(f"[INFO] {source_repo} -> {target_repo} using token pair #{token_index}", flush=True)
+        # The prefix keeps interleaved output from parallel workers attributable
+        live_prefix = f"[{source_repo} -> {target_repo}] "
+
+        # Id of a migration that is already queued on the server. A retry waits
+        # on it instead of starting a second migration of the same repo.
+        migration_id = None
+        for attempt in range(1, MIGRATE_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                action = f"resuming {migration_id}" if migration_id else "restarting"
+                LOG_Q.put((str(per_repo_log), f"\n===== Attempt {attempt}/{MIGRATE_MAX_ATTEMPTS} ({action}) =====\n".encode("utf-8")))
+
+            if MIGRATION_BACKEND == "api":
+                success, output, migration_id, retryable = run_api_migration(
+                    source_repo,
+                    target_repo,
+                    source_token,
+                    target_token,
+                    live_prefix=live_prefix,
+                    log_path=str(per_repo_log),
+                    migration_id=migration_id
+                )
+            else:
+                env = os.environ.copy()
+                env["GH_SOURCE_PAT"] = source_token
+                env["GH_PAT"] = target_token
+
+                success, output = run_streaming(
+                    build_wait_cmd(migration_id) if migration_id else build_cmd(source_repo, target_repo),
+                    live_prefix=live_prefix,
+                    log_path=str(per_repo_log),
+                    env=env
+                )
+                migration_id = None if success else _queued_migration_id(output)
+                retryable = _is_retryable(output)
+
+            if success or ABORT.is_set() or attempt == MIGRATE_MAX_ATTEMPTS or not retryable:
+                break
+            # Jittered exponential backoff: ~1s, 2s, 4s, 8s ... capped at 60s
+            delay = min(60, 2 ** (attempt - 1) + random.random())
+            action = f"resuming {migration_id}" if migration_id else "restarting"
+            print(
+                f"[RETRY] {source_repo} -> {target_repo} hit a transient error; "
+                f"attempt {attempt + 1}/{MIGRATE_MAX_ATTEMPTS} ({action}) in {delay:.1f}s",
+                flush=True
+            )
+            if ABORT.wait(delay):
+                break
+    finally:
+        tokens.put((token_index, source_token, target_token))
+    duration_seconds = time.monotonic() - start_mono
+    end_time = datetime.now(timezone.utc)
+    duration_minutes = round(duration_seconds / 60, 2)
+
+    with progress["lock"]:
+        progress["completed"] += 1
+        completed = progress["completed"]
+
+    status_msg = "Completed" if success else ("Aborted" if ABORT.is_set() else "Failed")
+    print(
+        f"[{status_msg}] {source_repo} -> {target_repo} "
+        f"(#{completed}) in {round(duration_seconds, 2)}s",
+        flush=True
+    )
 
-    for row in repo_list:
-        source_repo = (row.get("CURRENT-NAME") or "").strip()
-        target_repo = (row.get("NEW-NAME") or "").strip()
+    if not success and not ABORT.is_set():
+        logging.error(
+            "Migration failed for %s -> %s after %d attempt(s) (token pair #%d, full log: %s)\n%s",
+            source_repo, target_repo, attempt, token_index, per_repo_log, output
+        )
 
-        # Fallback: if NEW-NAME blank, reuse CURRENT-NAME
-        if not target_repo:
-            target_repo = source_repo
+    return [
+        SOURCE_ORG,
+        source_repo,
+        DESTINATION_ORG,
+        target_repo,
+        "Success" if success else ("Aborted" if ABORT.is_set() else "Failed"),
+        _csv_time(start_time),
+        _csv_time(end_time),
+        round(duration_seconds, 2),
+        duration_minutes,
+        str(per_repo_log),
+        attempt
+    ]
 
-        print(f"\nStarting migration: {SOURCE_ORG}/{source_repo} -> {DESTINATION_ORG}/{target_repo}", flush=True)
+def _pace_rate_limit(resp):
+    """Sleep until the rate-limit window resets if we are close to running out."""
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    reset = resp.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None or int(remaining) >= RATE_LIMIT_FLOOR:
+        return
+    wait = max(0, int(reset) - int(time.time())) + 1
+    print(f"[WARN] Rate limit low ({remaining} left). Sleeping {wait}s until reset.", flush=True)
+    time.sleep(wait)
 
-        cmd = (
-            f'"{GH_CLI}" gei migrate-repo '
-            f'--github-source-org "{SOURCE_ORG}" '
-            f'--source-repo "{source_repo}" '
-            f'--github-target-org "{DESTINATION_ORG}" '
-            f'--target-repo "{target_repo}" '
-            f'--target-api-url "{TARGET_API_URL}"'
+def graphql(query, variables, token, etag_cache=None, ignore_not_found=False):
+    """
+    POST a GraphQL query to the target API and return its `data`.
+    If `etag_cache` (a dict keyed by query) is given, the last ETag for this
+    query is sent as If-None-Match and a 304 reuses the cached data; 304s do
+    not count against the primary rate limit.
+    With ignore_not_found, NOT_FOUND errors are dropped (those fields are null).
+    Raises RuntimeError on GraphQL errors and requests exceptions on HTTP errors.
+    """
+    headers = {"Authorization": f"bearer {token}"}
+    cached = etag_cache.get(query) if etag_cache is not None else None
+    if cached:
+        headers["If-None-Match"] = cached[0]
+
+    resp = SESSION.post(
+        GRAPHQL_URL,
+        json={"query": query, "variables": variables},
+        headers=headers,
+        timeout=60,
+    )
+    _pace_rate_limit(resp)
+    if resp.status_code == 304 and cached:
+        return cached[1]
+    resp.raise_for_status()
+    body = resp.json()
+    errors = body.get("errors") or []
+    if ignore_not_found:
+        errors = [err for err in errors if err.get("type") != "NOT_FOUND"]
+    if errors:
+        raise RuntimeError("; ".join(err.get("message", str(err)) for err in errors))
+    if etag_cache is not None and resp.headers.get("ETag"):
+        etag_cache[query] = (resp.headers["ETag"], body["data"])
+    return body["data"]
+
+def _migration_ids(target_token):
+    """Return (owner_id, migration_source_id) for DESTINATION_ORG, creating the source once."""
+    with _api_ids_lock:
+        if not _api_ids:
+            data = graphql(
+                "query($login: String!) { organization(login: $login) { id } }",
+                {"login": DESTINATION_ORG},
+                target_token,
+            )
+            owner_id = data["organization"]["id"]
+            data = graphql(
+                """mutation($name: String!, $url: String!, $ownerId: ID!) {
+                  createMigrationSource(input: {name: $name, url: $url, ownerId: $ownerId, type: GITHUB_ARCHIVE}) {
+                    migrationSource { id }
+                  }
+                }""",
+                {"name": "GHEC Source", "url": SOURCE_URL, "ownerId": owner_id},
+                target_token,
+            )
+            _api_ids["owner_id"] = owner_id
+            _api_ids["source_id"] = data["createMigrationSource"]["migrationSource"]["id"]
+        return _api_ids["owner_id"], _api_ids["source_id"]
+
+def start_migration(src_org, src_repo, tgt_org, tgt_repo, source_token, target_token):
+    """Queue a repository migration via startRepositoryMigration and return its id."""
+    owner_id, source_id = _migration_ids(target_token)
+    data = graphql(
+        """mutation($sourceId: ID!, $ownerId: ID!, $sourceRepositoryUrl: URI!, $repositoryName: String!,
+                    $accessToken: String!, $githubPat: String!) {
+          startRepositoryMigration(input: {
+            sourceId: $sourceId, ownerId: $ownerId, sourceRepositoryUrl: $sourceRepositoryUrl,
+            repositoryName: $repositoryName, continueOnError: true,
+            accessToken: $accessToken, githubPat: $githubPat
+          }) {
+            repositoryMigration { id }
+          }
+        }""",
+        {
+            "sourceId": source_id,
+            "ownerId": owner_id,
+            "sourceRepositoryUrl": f"{SOURCE_URL}/{src_org}/{src_repo}",
+            "repositoryName": tgt_repo,
+            "accessToken": source_token,
+            "githubPat": target_token,
+        },
+        target_token,
+    )
+    return data["startRepositoryMigration"]["repositoryMigration"]["id"]
+
+def find_existing_repos(names, target_token):
+    """
+    Return the subset of `names` that already exist in DESTINATION_ORG, using
+    one aliased repository() lookup per PREFLIGHT_BATCH_SIZE names.
+    """
+    names = list(names)
+    existing = set()
+    for offset in range(0, len(names), PREFLIGHT_BATCH_SIZE):
+        batch = names[offset:offset + PREFLIGHT_BATCH_SIZE]
+        selections = "\n".join(
+            f"r{i}: repository(owner: {json.dumps(DESTINATION_ORG)}, name: {json.dumps(name)}) {{ id updatedAt }}"
+            for i, name in enumerate(batch)
         )
+        data = graphql(f"query {{\n{selections}\n}}", {}, target_token, ignore_not_found=True)
+        existing.update(name for i, name in enumerate(batch) if data.get(f"r{i}"))
+    return existing
 
-        start_time = datetime.now(timezone.utc)
-        per_repo_log = LOGS_DIR / f"{safe_log_name(source_repo)}__to__{safe_log_name(target_repo)}.log"
+def skip_existing(rows, target_token, on_skip):
+    """
+    Filter (source_repo, target_repo) rows, dropping those whose target
+    repo already exists. Rows are checked PREFLIGHT_BATCH_SIZE at a time, so
+    the CSV is still streamed. Calls on_skip(source_repo, target_repo) for
+    each dropped row. If a check fails, that batch is migrated unfiltered.
+    """
+    def flush(batch):
+        try:
+            existing = find_existing_repos({target for _, target in batch}, target_token)
+        except (requests.RequestException, RuntimeError, KeyError, TypeError) as e:
+            print(f"[WARN] Existing-repo check failed, migrating this batch anyway: {e}", flush=True)
+            existing = set()
+        for source_repo, target_repo in batch:
+            if target_repo in existing:
+                on_skip(source_repo, target_repo)
+            else:
+                yield source_repo, target_repo
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= PREFLIGHT_BATCH_SIZE:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
+def _is_rate_limited(resp):
+    """True if an HTTP error response is GitHub's primary or secondary rate limit."""
+    if resp.status_code == 429:
+        return True
+    return resp.status_code == 403 and (
+        resp.headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in resp.headers
+        or "rate limit" in resp.text.lower()
+    )
 
-        success, output = run_streaming(
-            cmd,
-            live_prefix=f"[{source_repo} -> {target_repo}] ",
-            log_path=str(per_repo_log),
-            env=env
-        )
-        end_time = datetime.now(timezone.utc)
+def _is_transient_api_error(e):
+    """True if an API request failed on the network, a rate limit or a 5xx."""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    resp = getattr(e, "response", None)
+    if isinstance(e, requests.HTTPError) and resp is not None:
+        return _is_rate_limited(resp) or resp.status_code >= 500
+    return False
+
+def _never_sent(e):
+    """True if an API request failed before it reached the server."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if isinstance(e, requests.ConnectionError) and e.args else None
+    return isinstance(reason, NewConnectionError)
+
+def _poll_failed(mids, error):
+    """
+    Count a failed status read for each migration id; give up (fail its future)
+    on those that reached MAX_POLL_FAILURES consecutive failures.
+    """
+    with _in_flight_lock:
+        for mid in mids:
+            entry = _in_flight.get(mid)
+            if entry is None:
+                continue  # already resolved (e.g. aborted)
+            entry["failures"] += 1
+            if entry["failures"] >= MAX_POLL_FAILURES:
+                _in_flight.pop(mid)
+                entry["future"].set_exception(
+                    RuntimeError(f"Status polling failed {MAX_POLL_FAILURES} times in a row: {error}")
+                )
+
+def _poll_in_flight():
+    """
+    Poller thread: every POLL_INTERVAL_SECONDS, fetch the state of all in-flight
+    migrations with aliased node() lookups (POLL_BATCH_SIZE per request) and
+    resolve the futures of those that finished. Exits once nothing is in flight.
+    Failed polls are retried on the next tick (the migrations keep running on
+    the server); a future only fails fast on a non-rate-limit 4xx, or after
+    MAX_POLL_FAILURES consecutive failures.
+    """
+    global _poller
+    # batch query -> (etag, data); only batches polled in the last tick are kept
+    etags = {}
+    while True:
+        time.sleep(POLL_INTERVAL_SECONDS)
+        with _in_flight_lock:
+            if not _in_flight:
+                _poller = None
+                return
+            entries = dict(_in_flight)
+        mids = list(entries)
+
+        polled = set()
+        for offset in range(0, len(mids), POLL_BATCH_SIZE):
+            batch = mids[offset:offset + POLL_BATCH_SIZE]
+            selections = "\n".join(
+                f"m{i}: node(id: {json.dumps(mid)}) {{ ... on RepositoryMigration {{ state failureReason }} }}"
+                for i, mid in enumerate(batch)
+            )
+            query = f"query {{\n{selections}\n}}"
+            polled.add(query)
+            try:
+                # NOT_FOUND (e.g. a stale id) only nulls that node, not the whole batch
+                data = graphql(query, {}, entries[batch[0]]["token"], etag_cache=etags, ignore_not_found=True)
+            except requests.HTTPError as e:
+                resp = e.response
+                if resp is not None and 400 <= resp.status_code < 500 and not _is_rate_limited(resp):
+                    # Bad or revoked token, missing endpoint: polling again won't help
+                    print(f"[ERROR] Status poll rejected, giving up on {len(batch)} migration(s): {e}", flush=True)
+                    with _in_flight_lock:
+                        for mid in batch:
+                            entry = _in_flight.pop(mid, None)
+                            if entry:
+                                entry["future"].set_exception(e)
+                    continue
+                print(f"[WARN] Status poll failed, retrying next tick: {e}", flush=True)
+                _poll_failed(batch, e)
+                continue
+            except (requests.RequestException, RuntimeError, ValueError) as e:
+                # Network hiccup or GraphQL-level error (RATE_LIMITED, "Something went wrong"):
+                # the migrations are still running server-side, so try again next tick
+                print(f"[WARN] Status poll failed, retrying next tick: {e}", flush=True)
+                _poll_failed(batch, e)
+                continue
+
+            for i, mid in enumerate(batch):
+                node = data.get(f"m{i}")
+                if not node:
+                    _poll_failed([mid], f"migration {mid} not found")
+                    continue
+                state = node.get("state")
+                entry = entries[mid]
+                entry["failures"] = 0
+                if state and state != entry["state"]:
+                    entry["state"] = state
+                    if entry["on_state"]:
+                        entry["on_state"](state)
+                if state in FINISHED_STATES:
+                    with _in_flight_lock:
+                        if _in_flight.pop(mid, None) is None:
+                            continue  # already resolved (e.g. aborted)
+                    entry["future"].set_result((state, node.get("failureReason")))
+
+        for query in set(etags) - polled:
+            del etags[query]
+
+def poll_migration(mid, target_token, on_state=None):
+    """
+    Wait for a migration to reach a terminal state.
+    The migration is registered with the shared poller thread, which batches
+    status checks for every in-flight migration into one request per tick.
+    Calls on_state(state) whenever the state changes.
+    Returns (state, failure_reason).
+    """
+    global _poller
+    future = Future()
+    with _in_flight_lock:
+        if ABORT.is_set():
+            raise RuntimeError("Interrupted by user")
+        _in_flight[mid] = {
+            "future": future, "token": target_token, "on_state": on_state, "state": None, "failures": 0
+        }
+        if _poller is None:
+            _poller = threading.Thread(target=_poll_in_flight, name="migration-poller", daemon=True)
+            _poller.start()
+    return future.result()
+
+def run_api_migration(source_repo, target_repo, source_token, target_token, live_prefix="", log_path=None,
+                      migration_id=None):
+    """
+    Migrate one repo through the GraphQL API, streaming state changes to the
+    console (unless QUIET) and the optional log file.
+    If migration_id is given, that already queued migration is polled instead
+    of starting a new one.
+    Returns (success: bool, combined_output: str, pending_id, retryable) where
+    pending_id is the id of a queued migration whose final state could not be
+    read (so a retry should resume it), or None, and retryable tells whether
+    the failure was transient. A start request that may have reached GitHub
+    before failing (read timeout, dropped connection, 5xx) is not retryable,
+    since a retry could start a second migration of the same repo.
+    """
+    if log_path:
+        LOG_Q.put((log_path, b""))
 
-        duration_seconds = (end_time - start_time).total_seconds()
-        duration_minutes = round(duration_seconds / 60, 2)
-        completed += 1
+    output_lines = []
 
-        status_msg = "Completed" if success else "Failed"
-        print(
-            f"[{status_msg}] {source_repo} -> {target_repo} "
-            f"({completed}/{total}) in {round(duration_seconds, 2)}s",
-            flush=True
-        )
+    def emit(line):
+        if not QUIET:
+            print(f"{live_prefix}{line}", flush=True)
+        output_lines.append(line + "\n")
+        if log_path:
+            LOG_Q.put((log_path, (line + "\n").encode("utf-8")))
 
-        if not success:
-            logging.error("Migration failed for %s -> %s\n%s", source_repo, target_repo, output)
-
-        results.append({
-            "SourceOrg": SOURCE_ORG,
-            "SourceRepo": source_repo,
-            "TargetOrg": DESTINATION_ORG,
-            "TargetRepo": target_repo,
-            "Status": "Success" if success else "Failed",
-            "StartTime": start_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "EndTime": end_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "TimeTakenSeconds": round(duration_seconds, 2),
-            "TimeTakenMinutes": duration_minutes,
-            "LogFile": str(per_repo_log)
-        })
-
-    # Write summary CSV (utf-8-sig so Excel opens cleanly)
-    fieldnames = [
-        "SourceOrg", "SourceRepo", "TargetOrg", "TargetRepo",
-        "Status", "StartTime", "EndTime", "TimeTakenSeconds", "TimeTakenMinutes", "LogFile"
-    ]
-    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8-sig") as csvout:
-        writer = csv.DictWriter(csvout, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    success = False
+    pending_id = None
+    retryable = False
+    starting = False
+    try:
+        if migration_id:
+            emit(f"Resuming status checks for {migration_id}")
+        else:
+            # Resolve the org and migration source first so that only the
+            # startRepositoryMigration request itself counts as starting
+            _migration_ids(target_token)
+            starting = True
+            migration_id = start_migration(
+                SOURCE_ORG, source_repo, DESTINATION_ORG, target_repo, source_token, target_token
+            )
+            starting = False
+            emit(f"Migration queued: {migration_id}")
+        pending_id = migration_id
+        state, failure_reason = poll_migration(migration_id, target_token, on_state=lambda st: emit(f"State: {st}"))
+        pending_id = None
+        success = (state == "SUCCEEDED")
+        if failure_reason:
+            emit(f"Failure reason: {failure_reason}")
+    except (requests.RequestException, RuntimeError, KeyError, TypeError) as e:
+        if ABORT.is_set():
+            emit("[ABORTED] Interrupted by user (the queued migration keeps running on GitHub).")
+        else:
+            emit(f"[ERROR] {e}")
+            if starting:
+                # Only retry if GitHub certainly did not queue the migration
+                resp = getattr(e, "response", None)
+                retryable = _never_sent(e) or (
+                    isinstance(e, requests.HTTPError) and resp is not None and _is_rate_limited(resp)
+                )
+                if not retryable and isinstance(e, requests.RequestException):
+                    emit(
+                        f"[WARN] The migration may have been queued anyway; check {DESTINATION_ORG}/{target_repo} "
+                        "before running it again."
+                    )
+            elif pending_id and isinstance(e, RuntimeError):
+                # Status polling gave up; the migration is still queued, so resume it
+                retryable = True
+            else:
+                retryable = _is_transient_api_error(e)
+    finally:
+        if log_path:
+            LOG_Q.put((log_path, None))
+
+    return success, "".join(output_lines), pending_id, retryable
+
+def abort_migrations():
+    """
+    Called from the main thread on Ctrl+C: stop new work, terminate running gh
+    processes and release workers waiting on API status polls.
+    """
+    ABORT.set()
+    with _live_procs_lock:
+        for proc in _live_procs:
+            try:
+                proc.terminate()
+            except OSError:
+                pass
+    with _in_flight_lock:
+        for entry in _in_flight.values():
+            entry["future"].set_exception(RuntimeError("Interrupted by user"))
+        _in_flight.clear()
+
+def dry_run(csv_file):
+    """Print the migration each CSV row would start, without starting any."""
+    count = 0
+    with open(csv_file, newline="", encoding="utf-8-sig", errors="replace") as f:
+        for source_repo, target_repo in iter_repo_rows(f):
+            if MIGRATION_BACKEND == "api":
+                print(
+                    f"startRepositoryMigration {SOURCE_URL}/{SOURCE_ORG}/{source_repo} "
+                    f"-> {DESTINATION_ORG}/{target_repo}",
+                    flush=True
+                )
+            else:
+                print(shlex.join(build_cmd(source_repo, target_repo)), flush=True)
+            count += 1
+    print(f"\n[DRY RUN] {count} repo(s) would be migrated. Nothing was run.", flush=True)
+
+def migrate_repos(csv_file):
+    if DRY_RUN:
+        dry_run(csv_file)
+        return
+
+    print(f"[INFO] Reading repos from {csv_file}", flush=True)
+    print(f"[INFO] Running up to {MIGRATE_CONCURRENCY} migration(s) in parallel", flush=True)
+
+    progress = {"completed": 0, "lock": threading.Lock()}
+
+    # gh gei reads GH_SOURCE_PAT / GH_PAT from its environment, so each worker
+    # gets a copy of the current env with a token pair borrowed from this queue.
+    # Pairs are handed out round-robin; a pool smaller than the worker count is
+    # shared rather than limiting concurrency.
+    pairs = token_pairs()
+    tokens = queue.Queue()
+    for slot in range(max(len(pairs), MIGRATE_CONCURRENCY)):
+        token_index = slot % len(pairs)
+        tokens.put((token_index, *pairs[token_index]))
+    print(f"[INFO] Using {len(pairs)} token pair(s)", flush=True)
+
+    # Summary CSV (utf-8-sig so Excel opens cleanly) is written row by row as
+    # migrations finish, so a crash keeps everything completed so far.
+    out_f = open(OUTPUT_FILE, "w", newline="", encoding="utf-8-sig")
+    out_w = csv.writer(out_f)
+    out_w.writerow(FIELDNAMES)
+    out_lock = threading.Lock()
+
+    def write_row(future):
+        if not future.cancelled() and future.exception() is None:
+            with out_lock:
+                out_w.writerow(future.result())
+                out_f.flush()
+
+    skipped = 0
+
+    def write_skipped(source_repo, target_repo):
+        nonlocal skipped
+        skipped += 1
+        print(f"[Skipped] {source_repo} -> {target_repo}: {DESTINATION_ORG}/{target_repo} already exists", flush=True)
+        with out_lock:
+            out_w.writerow([
+                SOURCE_ORG, source_repo, DESTINATION_ORG, target_repo,
+                "Skipped-Exists", "", "", 0, 0, "", 0
+            ])
+            out_f.flush()
+
+    total = 0
+    aborted = False
+    log_writer = start_log_writer()
+    executor = ThreadPoolExecutor(max_workers=MIGRATE_CONCURRENCY)
+    try:
+        # Read CSV with UTF-8 (support BOM) and feed rows to the workers as they are
+        # parsed, keeping at most 2 x MIGRATE_CONCURRENCY jobs queued at a time.
+        with open(csv_file, newline="", encoding="utf-8-sig", errors="replace") as f:
+            rows = iter_repo_rows(f)
+            if SKIP_EXISTING:
+                # One bulk lookup per batch instead of discovering existing repos via failed migrations
+                rows = skip_existing(rows, pairs[0][1], write_skipped)
+            pending = set()
+            for source_repo, target_repo in rows:
+                if len(pending) >= 2 * MIGRATE_CONCURRENCY:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()  # re-raise worker errors here
+                future = executor.submit(_migrate_one, source_repo, target_repo, progress, tokens)
+                future.add_done_callback(write_row)
+                pending.add(future)
+                total += 1
+            done, _ = wait(pending)
+            for future in done:
+                future.result()
+    except KeyboardInterrupt:
+        # Ctrl+C is only delivered to this (main) thread: stop the workers from here
+        aborted = True
+        print("\n[ABORTED] Interrupted by user. Stopping running migrations; queued repos will not start.", flush=True)
+        abort_migrations()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        stop_log_writer(log_writer)
+        out_f.close()
+
+    if aborted:
+        print(f"Partial details -> {OUTPUT_FILE}", flush=True)
+        raise SystemExit(130)
+
+    if total == 0 and skipped == 0:
+        print("[INFO] No repositories found in CSV (CURRENT-NAME column). Nothing to do.", flush=True)
+        return
 
-    print(f"\nAll migrations finished. {completed}/{total} repos processed.", flush=True)
+    print(f"\nAll migrations finished. {total} repos processed, {skipped} skipped (already exist).", flush=True)
     print(f"Details -> {OUTPUT_FILE}", flush=True)
     print(f"Errors  -> migration_errors.log", flush=True)
     print(f"Per-repo logs -> {LOGS_DIR.resolve()}", flush=True)